@@ -4,18 +4,43 @@ FastAPI backend using OpenAI Agents SDK with MCP Streamable HTTP
 """
 
 import asyncio
-import json
+import math
 import os
 import re
+import secrets
+import threading
 import uuid
+from collections import OrderedDict
 from datetime import datetime
+from functools import lru_cache
+from itertools import islice
+from typing import Annotated, Literal
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException
+import anyio
+import orjson
+import xxhash
+from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field, field_validator
-from openai import OpenAI
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, StringConstraints, field_validator, model_validator
+from openai import AsyncOpenAI
+from openai.types.responses import ResponseTextDeltaEvent
 from agents import Agent, Runner
+from agents.exceptions import UserError
 from agents.mcp import MCPServerStreamableHttp
+from config import MCP_SERVER_URL
+from instructions import build_instructions
+from mcp_connection import SharedMCPServer, ToolCallHooks
+
+try:
+    import hyperscan
+except ImportError:  # Not available on Windows/macOS dev machines
+    hyperscan = None
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 
 # =============================================================================
@@ -25,85 +50,229 @@ from agents.mcp import MCPServerStreamableHttp
 # Patterns that indicate prompt injection attempts
 INJECTION_PATTERNS = [
     # System prompt manipulation
-    r'(?i)ignore\s+(all\s+)?(previous|above|prior)\s+(instructions?|prompts?|rules?)',
-    r'(?i)disregard\s+(all\s+)?(previous|above|prior)',
-    r'(?i)forget\s+(everything|all|your)\s+(above|previous|instructions?)',
-    r'(?i)new\s+instructions?:',
-    r'(?i)system\s*:\s*you\s+are',
-    r'(?i)assistant\s*:\s*',
-    r'(?i)\[system\]',
-    r'(?i)\[inst\]',
-    r'(?i)<\|system\|>',
-    r'(?i)<\|assistant\|>',
-    r'(?i)<<\s*SYS\s*>>',
+    r'ignore\s+(all\s+)?(previous|above|prior)\s+(instructions?|prompts?|rules?)',
+    r'disregard\s+(all\s+)?(previous|above|prior)',
+    r'forget\s+(everything|all|your)\s+(above|previous|instructions?)',
+    r'new\s+instructions?:',
+    r'system\s*:\s*you\s+are',
+    r'assistant\s*:\s*',
+    r'\[system\]',
+    r'\[inst\]',
+    r'<\|system\|>',
+    r'<\|assistant\|>',
+    r'<<\s*SYS\s*>>',
 
     # Role manipulation
-    r'(?i)pretend\s+(to\s+be|you\'?re?\s+)',
-    r'(?i)act\s+as\s+(if\s+you\'?re?|a\s+different)',
-    r'(?i)you\s+are\s+now\s+',
-    r'(?i)switch\s+(to\s+|your\s+)?(role|persona|character)',
-    r'(?i)roleplay\s+as',
+    r'pretend\s+(to\s+be|you\'?re?\s+)',
+    r'act\s+as\s+(if\s+you\'?re?|a\s+different)',
+    r'you\s+are\s+now\s+',
+    r'switch\s+(to\s+|your\s+)?(role|persona|character)',
+    r'roleplay\s+as',
 
     # Instruction override
-    r'(?i)override\s+(your\s+)?(instructions?|programming|rules?)',
-    r'(?i)bypass\s+(your\s+)?(restrictions?|limitations?|filters?)',
-    r'(?i)jailbreak',
-    r'(?i)dan\s+mode',
-    r'(?i)developer\s+mode',
+    r'override\s+(your\s+)?(instructions?|programming|rules?)',
+    r'bypass\s+(your\s+)?(restrictions?|limitations?|filters?)',
+    r'jailbreak',
+    r'dan\s+mode',
+    r'developer\s+mode',
 
     # Data exfiltration attempts
-    r'(?i)reveal\s+(your\s+)?(system\s+)?(prompt|instructions?)',
-    r'(?i)show\s+(me\s+)?(your\s+)?(system\s+)?(prompt|instructions?)',
-    r'(?i)what\s+(are\s+)?(your\s+)?(system\s+)?(instructions?|prompt)',
-    r'(?i)print\s+(your\s+)?(system\s+)?(prompt|instructions?)',
-    r'(?i)output\s+(your\s+)?(initial|system)\s+(prompt|instructions?)',
+    r'reveal\s+(your\s+)?(system\s+)?(prompt|instructions?)',
+    r'show\s+(me\s+)?(your\s+)?(system\s+)?(prompt|instructions?)',
+    r'what\s+(are\s+)?(your\s+)?(system\s+)?(instructions?|prompt)',
+    r'print\s+(your\s+)?(system\s+)?(prompt|instructions?)',
+    r'output\s+(your\s+)?(initial|system)\s+(prompt|instructions?)',
 
     # Encoding/obfuscation attempts
-    r'(?i)base64\s*(decode|encode)',
-    r'(?i)rot13',
-    r'(?i)hex\s*(decode|encode)',
+    r'base64\s*(decode|encode)',
+    r'rot13',
+    r'hex\s*(decode|encode)',
 
     # Tool abuse attempts
-    r'(?i)call\s+(any|all)\s+tools?',
-    r'(?i)execute\s+(arbitrary|any)\s+(code|command)',
+    r'call\s+(any|all)\s+tools?',
+    r'execute\s+(arbitrary|any)\s+(code|command)',
+]
+
+# Lowercase literals, one of which must appear in any text matched by the
+# pattern at the same index in INJECTION_PATTERNS
+INJECTION_LITERALS = [
+    ('ignore',),
+    ('disregard',),
+    ('forget',),
+    ('instruction',),
+    ('system',),
+    ('assistant',),
+    ('[system]',),
+    ('[inst]',),
+    ('<|system|>',),
+    ('<|assistant|>',),
+    ('<<',),
+
+    ('pretend',),
+    ('act',),
+    ('now',),
+    ('switch',),
+    ('roleplay',),
+
+    ('override',),
+    ('bypass',),
+    ('jailbreak',),
+    ('mode',),
+    ('developer',),
+
+    ('reveal',),
+    ('prompt', 'instruction'),
+    ('prompt', 'instruction'),
+    ('prompt', 'instruction'),
+    ('prompt', 'instruction'),
+
+    ('base64',),
+    ('rot13',),
+    ('hex',),
+
+    ('tool',),
+    ('execute',),
 ]
+assert len(INJECTION_LITERALS) == len(INJECTION_PATTERNS)
+
+# All patterns combined into one case-insensitive alternation, compiled once.
+# Each pattern is wrapped in a named group so the match can be traced back.
+INJECTION_RE = re.compile(
+    "|".join(f"(?P<inj_{i}>{p})" for i, p in enumerate(INJECTION_PATTERNS)),
+    re.IGNORECASE,
+)
+
+# Hyperscan database scanning all patterns in a single pass (falls back to
+# INJECTION_RE when the hyperscan bindings are not installed)
+if hyperscan is not None:
+    _HS_DB = hyperscan.Database(mode=hyperscan.HS_MODE_BLOCK)
+    _HS_DB.compile(
+        expressions=[p.encode() for p in INJECTION_PATTERNS],
+        ids=list(range(len(INJECTION_PATTERNS))),
+        elements=len(INJECTION_PATTERNS),
+        flags=[hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_SINGLEMATCH] * len(INJECTION_PATTERNS),
+    )
+else:
+    _HS_DB = None
+
+# Hyperscan scratch space cannot be shared between threads
+_hs_local = threading.local()
+
+# Text Hyperscan may scan: its caseless matching and \s are ASCII-only, and
+# its \s also lacks the \x1c-\x1f separators Python's re treats as spaces, so
+# any other text goes to INJECTION_RE
+_HS_SAFE_TEXT_RE = re.compile(r'[\x00-\x1b\x20-\x7f]*')
+
+# Aho-Corasick prefilter for the regex fallback: text containing none of the
+# literals cannot match any pattern, so the regex scan can be skipped. Only
+# used for ASCII text, since re.IGNORECASE folds some non-ASCII letters (e.g.
+# "İ", "ſ") to ASCII ones that lowercasing does not.
+if hyperscan is None and ahocorasick is not None:
+    _INJECTION_AC = ahocorasick.Automaton()
+    for idx, literals in enumerate(INJECTION_LITERALS):
+        for literal in literals:
+            _INJECTION_AC.add_word(literal, idx)
+    _INJECTION_AC.make_automaton()
+else:
+    _INJECTION_AC = None
+
+# Delimiters stripped by sanitize_message, in a single alternation: role code
+# fences are neutralised, chat-template tokens are removed
+_SANITIZE_RE = re.compile(
+    r'(?P<fence>```\s*(?:system|assistant|user)\s*)'
+    r'|<\|(?:system|assistant|user|im_start|im_end)\|>'
+    r'|<<\s*(?:SYS|INST)\s*>>'
+    r'|\[/(?:INST|SYS)\]'
+)
+
+# Bound on sanitize_message passes, so nested delimiters cannot make it
+# quadratic
+SANITIZE_MAX_PASSES = 4
 
 # Maximum message length (prevent token stuffing)
 MAX_MESSAGE_LENGTH = 4000
 MAX_HISTORY_MESSAGES = 20
 
+# Requests with more text than this (message + history) are scanned for
+# injection in a worker thread instead of on the event loop
+INLINE_SCAN_MAX_CHARS = 40_000
+
+# Keys accepted in the client-supplied customer state
+CUSTOMER_STATE_KEYS = ('verified', 'customer_id', 'name')
+
+
+def _hs_on_match(pattern_id: int, start: int, end: int, flags: int, hits: list) -> bool:
+    hits.append(pattern_id)
+    return True  # Stop scanning at the first hit
+
 
 def detect_injection(text: str) -> tuple[bool, str | None]:
     """Check if text contains potential prompt injection patterns."""
-    for pattern in INJECTION_PATTERNS:
-        if re.search(pattern, text):
-            return True, pattern
+    if _HS_DB is not None and _HS_SAFE_TEXT_RE.fullmatch(text):
+        scratch = getattr(_hs_local, "scratch", None)
+        if scratch is None:
+            scratch = _hs_local.scratch = hyperscan.Scratch(_HS_DB)
+        hits = []
+        try:
+            _HS_DB.scan(text.encode(), match_event_handler=_hs_on_match, context=hits, scratch=scratch)
+        except hyperscan.ScanTerminated:
+            pass
+        if hits:
+            return True, INJECTION_PATTERNS[hits[0]]
+        return False, None
+
+    if _INJECTION_AC is not None and text.isascii() and next(_INJECTION_AC.iter(text.lower()), None) is None:
+        return False, None
+
+    match = INJECTION_RE.search(text)
+    if match:
+        return True, INJECTION_PATTERNS[int(match.lastgroup.removeprefix("inj_"))]
     return False, None
 
 
+# Hashes of texts that already passed detect_injection (most recent last), so
+# history resent by the client on every turn is only scanned once. The hash
+# is seeded per process so collisions cannot be precomputed.
+MAX_SCANNED_TEXTS = 50_000
+_scanned_clean: OrderedDict[int, None] = OrderedDict()
+_scanned_clean_lock = threading.Lock()  # Large scans run in worker threads
+_SCAN_HASH_SEED = secrets.randbits(64)
+
+
+def detect_injection_cached(text: str) -> tuple[bool, str | None]:
+    """detect_injection, skipping texts already found clean."""
+    key = xxhash.xxh3_64_intdigest(text.encode(errors="surrogatepass"), seed=_SCAN_HASH_SEED)
+    with _scanned_clean_lock:
+        if key in _scanned_clean:
+            _scanned_clean.move_to_end(key)
+            return False, None
+
+    is_injection, pattern = detect_injection(text)
+    if not is_injection:
+        with _scanned_clean_lock:
+            _scanned_clean[key] = None
+            if len(_scanned_clean) > MAX_SCANNED_TEXTS:
+                _scanned_clean.popitem(last=False)
+    return is_injection, pattern
+
+
+def _sanitize_replacement(match: re.Match) -> str:
+    return '``` ' if match.lastgroup == 'fence' else ''
+
+
 def sanitize_message(text: str) -> str:
     """Sanitize user input by removing potentially dangerous patterns."""
-    # Remove common delimiters used in prompt injection
-    sanitized = re.sub(r'```\s*(system|assistant|user)\s*', '``` ', text)
-    sanitized = re.sub(r'<\|(system|assistant|user|im_start|im_end)\|>', '', sanitized)
-    sanitized = re.sub(r'<<\s*(SYS|INST)\s*>>', '', sanitized)
-    sanitized = re.sub(r'\[/(INST|SYS)\]', '', sanitized)
+    # Remove common delimiters used in prompt injection, repeating while
+    # removals join fragments into new delimiters (e.g. "<<<|user|>SYS>>"),
+    # up to the four passes the separate patterns used to make
+    sanitized, count = _SANITIZE_RE.subn(_sanitize_replacement, text)
+    for _ in range(SANITIZE_MAX_PASSES - 1):
+        if not count:
+            break
+        sanitized, count = _SANITIZE_RE.subn(_sanitize_replacement, sanitized)
 
     return sanitized.strip()
 
-# Load .env file if present
-from pathlib import Path
-env_path = Path(__file__).parent / ".env"
-if env_path.exists():
-    with open(env_path) as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith("#") and "=" in line:
-                key, value = line.split("=", 1)
-                os.environ.setdefault(key.strip(), value.strip())
-
-# Configuration
-MCP_SERVER_URL = os.getenv("MCP_SERVER_URL", "https://vipfapwm3x.us-east-1.awsapprunner.com/mcp")
 
 BASE_INSTRUCTIONS = """You are a helpful customer support agent for TechStore, a computer products retailer.
 
@@ -133,40 +302,49 @@ Guidelines:
 
 def get_instructions(customer_state: dict) -> str:
     """Build instructions with customer state"""
-    if customer_state.get("verified"):
-        return BASE_INSTRUCTIONS + f"""
+    return build_instructions(BASE_INSTRUCTIONS, customer_state)
 
-IMPORTANT - VERIFIED CUSTOMER SESSION:
-The customer has already been verified. DO NOT ask for verification again.
-- Customer Name: {customer_state.get('name')}
-- Customer ID: {customer_state.get('customer_id')}
 
-Use this customer_id directly for list_orders and create_order calls. The customer is already authenticated.
-"""
-    return BASE_INSTRUCTIONS
+@lru_cache(maxsize=512)
+def build_agent(instructions: str, mcp_server: MCPServerStreamableHttp) -> Agent:
+    """Create the support agent bound to an MCP server connection (cached per instructions/connection)"""
+    return Agent(
+        name="TechStore Support",
+        instructions=instructions,
+        model="gpt-4o-mini",
+        mcp_servers=[mcp_server]
+    )
 
 
-class Message(BaseModel):
-    role: str
-    content: str
+# MCP connection reused across requests, opened in the app lifespan (agents
+# bound to a replaced connection are dropped from the cache)
+shared_mcp_server = SharedMCPServer(MCP_SERVER_URL, on_reconnect=build_agent.cache_clear)
 
-    @field_validator('role')
-    @classmethod
-    def validate_role(cls, v: str) -> str:
-        if v not in ('user', 'assistant'):
-            raise ValueError('Role must be "user" or "assistant"')
-        return v
 
-    @field_validator('content')
-    @classmethod
-    def validate_content(cls, v: str) -> str:
-        if len(v) > MAX_MESSAGE_LENGTH:
-            raise ValueError(f'Message too long (max {MAX_MESSAGE_LENGTH} characters)')
-        return sanitize_message(v)
+# Patterns for detecting a successful verification in the agent response
+_CID_LABELLED_RE = re.compile(r'[Cc]ustomer[_ ]?[Ii][Dd][:\s]*([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})')
+# (gap between keyword and UUID is bounded so matching stays linear-time)
+_CID_NEAR_WORD_RE = re.compile(r'(?:verified|customer|id)[:\s]+.{0,64}?([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})', re.IGNORECASE)
+_NAME_WELCOME_RE = re.compile(r'(?:verified|welcome)[,:\s]+([A-Z][a-z]+(?:\s+[A-Z][a-z]+)*)')
+_NAME_VERIFIED_RE = re.compile(r'([A-Z][a-z]+(?:\s+[A-Z][a-z]+)*)\s+(?:has been verified|is verified|verified)')
+
+
+# Length limit enforced by pydantic-core rather than a Python validator
+MessageText = Annotated[str, StringConstraints(max_length=MAX_MESSAGE_LENGTH)]
+
+
+class Message(BaseModel):
+    role: Literal['user', 'assistant']
+    content: MessageText
+
+    @model_validator(mode='after')
+    def sanitize_content(self) -> 'Message':
+        self.content = sanitize_message(self.content)
+        return self
 
 
 class ChatRequest(BaseModel):
-    message: str
+    message: MessageText
     history: list[Message] = []
     customer_state: dict = {}
 
@@ -175,8 +353,6 @@ class ChatRequest(BaseModel):
     def validate_message(cls, v: str) -> str:
         if not v or not v.strip():
             raise ValueError('Message cannot be empty')
-        if len(v) > MAX_MESSAGE_LENGTH:
-            raise ValueError(f'Message too long (max {MAX_MESSAGE_LENGTH} characters)')
         return v
 
     @field_validator('history')
@@ -190,9 +366,9 @@ class ChatRequest(BaseModel):
     @field_validator('customer_state')
     @classmethod
     def validate_customer_state(cls, v: dict) -> dict:
-        # Only allow specific keys in customer state
-        allowed_keys = {'verified', 'customer_id', 'name'}
-        return {k: v[k] for k in v if k in allowed_keys}
+        # Only allow specific keys with string/boolean values in customer
+        # state (returns a fresh dict)
+        return {k: v[k] for k in CUSTOMER_STATE_KEYS if isinstance(v.get(k), (str, bool))}
 
 
 class ChatResponse(BaseModel):
@@ -205,9 +381,84 @@ class ChatResponse(BaseModel):
 # EVALUATION SYSTEM
 # =============================================================================
 
-# In-memory storage (replace with database for production)
-evaluations_store: dict[str, dict] = {}
-conversations_store: dict[str, dict] = {}
+# In-memory storage (replace with database for production), oldest first
+MAX_STORED_CONVERSATIONS = 10_000
+evaluations_store: OrderedDict[str, dict] = OrderedDict()
+conversations_store: OrderedDict[str, dict] = OrderedDict()
+
+EVALUATION_CATEGORIES = ["helpfulness", "accuracy", "tone", "completeness", "safety"]
+
+# Running totals over evaluations_store for the dashboard summary
+evaluation_totals = {
+    "with_user_feedback": 0,
+    "with_llm_evaluation": 0,
+    "thumbs_up": 0,
+    "llm_score_sum": 0.0,
+    "llm_score_count": 0,
+    "category_sums": {cat: 0.0 for cat in EVALUATION_CATEGORIES},
+    "category_counts": {cat: 0 for cat in EVALUATION_CATEGORIES},
+}
+
+
+def judge_score(value) -> float | None:
+    """Return a score from the LLM judge output, or None if it is not a finite number."""
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        return None
+    return float(value)
+
+
+def count_evaluation(evaluation: dict, sign: int) -> None:
+    """Add (sign=1) or remove (sign=-1) an evaluation's contribution to the running totals.
+
+    Scores missing or malformed in the judge output are skipped, the same way
+    in both directions, so the totals stay consistent.
+    """
+    feedback = evaluation.get("user_feedback")
+    if feedback:
+        evaluation_totals["with_user_feedback"] += sign
+        if feedback.get("thumbs_up"):
+            evaluation_totals["thumbs_up"] += sign
+
+    llm_evaluation = evaluation.get("llm_evaluation")
+    if llm_evaluation:
+        evaluation_totals["with_llm_evaluation"] += sign
+        score = judge_score(llm_evaluation.get("overall_score"))
+        if score is not None:
+            evaluation_totals["llm_score_sum"] += sign * score
+            evaluation_totals["llm_score_count"] += sign
+        for cat in EVALUATION_CATEGORIES:
+            category = llm_evaluation.get(cat)
+            score = judge_score(category.get("score")) if isinstance(category, dict) else None
+            if score is not None:
+                evaluation_totals["category_sums"][cat] += sign * score
+                evaluation_totals["category_counts"][cat] += sign
+
+
+def store_conversation(conversation_id: str, conversation: dict) -> None:
+    """Store a conversation, evicting the least recently used ones over the limit."""
+    conversations_store[conversation_id] = conversation
+    while len(conversations_store) > MAX_STORED_CONVERSATIONS:
+        evicted_id, _ = conversations_store.popitem(last=False)
+        evaluation = evaluations_store.pop(evicted_id, None)
+        if evaluation:
+            count_evaluation(evaluation, -1)
+
+
+def get_or_create_evaluation(conversation_id: str) -> dict:
+    """Get the stored evaluation for a conversation, creating an empty one if needed."""
+    conv = conversations_store[conversation_id]
+    conversations_store.move_to_end(conversation_id)
+
+    if conversation_id not in evaluations_store:
+        evaluations_store[conversation_id] = {
+            "conversation_id": conversation_id,
+            "user_query": conv["user_query"],
+            "agent_response": conv["agent_response"],
+            "timestamp": conv["timestamp"],
+            "user_feedback": None,
+            "llm_evaluation": None,
+        }
+    return evaluations_store[conversation_id]
 
 
 class UserFeedback(BaseModel):
@@ -225,6 +476,21 @@ class EvaluationResult(BaseModel):
     timestamp: str
 
 
+class EvaluationSummary(BaseModel):
+    total_conversations: int
+    with_user_feedback: int
+    with_llm_evaluation: int
+    thumbs_up: int
+    thumbs_down: int
+    average_llm_score: float
+    category_averages: dict[str, float]
+
+
+class EvaluationsPage(BaseModel):
+    evaluations: list[dict]
+    summary: EvaluationSummary
+
+
 class LLMJudgeRequest(BaseModel):
     conversation_id: str
 
@@ -256,29 +522,46 @@ Respond in JSON format:
 """
 
 
+@lru_cache(maxsize=1)
+def get_judge_client() -> AsyncOpenAI:
+    """Shared async OpenAI client for the LLM judge (created on first use)."""
+    return AsyncOpenAI()
+
+
 async def run_llm_judge(user_query: str, agent_response: str) -> dict:
     """Run LLM-as-judge evaluation on a conversation."""
-    client = OpenAI()
+    client = get_judge_client()
 
     prompt = LLM_JUDGE_PROMPT.format(
         user_query=user_query,
         agent_response=agent_response
     )
 
-    response = client.chat.completions.create(
+    response = await client.chat.completions.create(
         model="gpt-4o-mini",
         messages=[{"role": "user", "content": prompt}],
         response_format={"type": "json_object"}
     )
 
-    return json.loads(response.choices[0].message.content)
+    result = orjson.loads(response.choices[0].message.content)
+    if not isinstance(result, dict):
+        raise HTTPException(status_code=502, detail="Invalid evaluation from LLM judge")
+    return result
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Startup
+    # Startup: allow more worker threads for offloaded injection scans
+    anyio.to_thread.current_default_thread_limiter().total_tokens = 100
+
+    # Open the shared MCP connection (retried on first chat if it fails)
+    try:
+        await shared_mcp_server.get()
+    except Exception as e:
+        print(f"[MCP] Could not connect to {MCP_SERVER_URL}: {e!r}")
     yield
     # Shutdown
+    await shared_mcp_server.close()
 
 
 app = FastAPI(title="TechStore Support API", lifespan=lifespan)
@@ -295,12 +578,10 @@ app.add_middleware(
 )
 
 
-@app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest) -> ChatResponse:
-    """Process chat message using OpenAI Agents SDK"""
-
+def check_injection(message: str, history: list[Message]) -> None:
+    """Raise an HTTP 400 if the message or its history contains prompt injection"""
     # Check for prompt injection in the current message
-    is_injection, pattern = detect_injection(request.message)
+    is_injection, pattern = detect_injection_cached(message)
     if is_injection:
         print(f"[SECURITY] Blocked injection attempt. Pattern: {pattern}")
         raise HTTPException(
@@ -309,8 +590,8 @@ async def chat(request: ChatRequest) -> ChatResponse:
         )
 
     # Also check history messages for injection
-    for msg in request.history:
-        is_injection, pattern = detect_injection(msg.content)
+    for msg in history:
+        is_injection, pattern = detect_injection_cached(msg.content)
         if is_injection:
             print(f"[SECURITY] Blocked injection in history. Pattern: {pattern}")
             raise HTTPException(
@@ -318,71 +599,174 @@ async def chat(request: ChatRequest) -> ChatResponse:
                 detail="Invalid message history detected."
             )
 
+
+async def prepare_conversation(request: ChatRequest) -> tuple[str, list[dict]]:
+    """Reject prompt injection and build the agent input for a chat request"""
+    # Scan inline unless the request is large enough to stall the event loop
+    total_chars = len(request.message) + sum(len(msg.content) for msg in request.history)
+    if total_chars > INLINE_SCAN_MAX_CHARS:
+        await anyio.to_thread.run_sync(check_injection, request.message, request.history)
+    else:
+        check_injection(request.message, request.history)
+
     # Sanitize the message
     sanitized_message = sanitize_message(request.message)
 
-    customer_state = request.customer_state.copy()
+    # Build conversation input with history
+    conversation = [{"role": msg.role, "content": msg.content} for msg in request.history]
+    conversation.append({"role": "user", "content": sanitized_message})
+
+    return sanitized_message, conversation
+
+
+def _may_have_cid_keyword(text: str) -> bool:
+    # Keyword check for _CID_NEAR_WORD_RE. Lowercasing only agrees with
+    # re.IGNORECASE on ASCII text (e.g. "İD" matches the regex), so non-ASCII
+    # text always goes to the regex.
+    if not text.isascii():
+        return True
+    lowered = text.lower()
+    return "customer" in lowered or "verified" in lowered or "id" in lowered
+
+
+def detect_verification(response_text: str, customer_state: dict) -> dict:
+    """Return the customer state, updated if the response shows a successful verification"""
+    # Look for Customer ID (UUID format) in any part of the response
+    # (skip the regexes when the response is too short to hold one)
+    if customer_state.get("verified") or len(response_text) < 36 or "-" not in response_text:
+        return customer_state
+
+    id_match = None
+
+    # Match UUID pattern that appears after verification, starting
+    # from the first "[Cc]ustomer" mention
+    start = response_text.find("ustomer")
+    if start != -1:
+        id_match = _CID_LABELLED_RE.search(response_text, max(start - 1, 0))
+    if not id_match and _may_have_cid_keyword(response_text):
+        # Also try to find standalone UUID after words like "verified" or "ID"
+        id_match = _CID_NEAR_WORD_RE.search(response_text)
+
+    if not id_match:
+        return customer_state
+
+    # Try to extract customer name
+    name_match = _NAME_WELCOME_RE.search(response_text)
+    if not name_match:
+        name_match = _NAME_VERIFIED_RE.search(response_text)
+
+    customer_state = {
+        "verified": True,
+        "customer_id": id_match.group(1),
+        "name": name_match.group(1).strip() if name_match else "Customer",
+    }
+    print(f"Customer verified: {customer_state}")
+    return customer_state
 
-    # Create fresh MCP connection for each request
-    async with MCPServerStreamableHttp(params={"url": MCP_SERVER_URL, "timeout": 30}) as mcp_server:
-        # Build instructions with customer state
-        instructions = get_instructions(customer_state)
 
-        agent = Agent(
-            name="TechStore Support",
-            instructions=instructions,
-            model="gpt-4o-mini",
-            mcp_servers=[mcp_server]
-        )
+def record_conversation(user_query: str, response_text: str, customer_state: dict) -> str:
+    """Store a finished exchange for evaluation and return its conversation ID"""
+    conversation_id = str(uuid.uuid4())
+    store_conversation(conversation_id, {
+        "user_query": user_query,
+        "agent_response": response_text,
+        "timestamp": datetime.utcnow().isoformat(),
+        "customer_state": customer_state,
+    })
+    return conversation_id
 
-        # Build conversation input with history
-        conversation = []
-        for msg in request.history:
-            conversation.append({"role": msg.role, "content": msg.content})
-        conversation.append({"role": "user", "content": sanitized_message})
-
-        # Run the agent with full conversation
-        result = await Runner.run(agent, conversation)
-
-        # Extract response text
-        response_text = result.final_output if hasattr(result, 'final_output') else str(result)
-
-        # Check if verification happened in this response
-        # Look for Customer ID (UUID format) in any part of the response
-        if not customer_state.get("verified"):
-            # Match UUID pattern that appears after verification
-            id_match = re.search(r'[Cc]ustomer[_ ]?[Ii][Dd][:\s]*([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})', response_text)
-            if not id_match:
-                # Also try to find standalone UUID after words like "verified" or "ID"
-                id_match = re.search(r'(?:verified|customer|id)[:\s]+.*?([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})', response_text, re.IGNORECASE)
-
-            # Try to extract customer name
-            name_match = re.search(r'(?:verified|welcome)[,:\s]+([A-Z][a-z]+(?:\s+[A-Z][a-z]+)*)', response_text)
-            if not name_match:
-                name_match = re.search(r'([A-Z][a-z]+(?:\s+[A-Z][a-z]+)*)\s+(?:has been verified|is verified|verified)', response_text)
-
-            if id_match:
-                customer_state = {
-                    "verified": True,
-                    "customer_id": id_match.group(1),
-                    "name": name_match.group(1).strip() if name_match else "Customer",
-                }
-                print(f"Customer verified: {customer_state}")
-
-        # Generate conversation ID and store for evaluation
-        conversation_id = str(uuid.uuid4())
-        conversations_store[conversation_id] = {
-            "user_query": sanitized_message,
-            "agent_response": response_text,
-            "timestamp": datetime.utcnow().isoformat(),
-            "customer_state": customer_state,
-        }
 
-        return ChatResponse(
-            message=response_text,
-            conversation_id=conversation_id,
-            customer_state=customer_state
-        )
+def sse_event(payload: dict) -> bytes:
+    """Encode a Server-Sent Event carrying a JSON payload"""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat(request: ChatRequest) -> ChatResponse:
+    """Process chat message using OpenAI Agents SDK"""
+    sanitized_message, conversation = await prepare_conversation(request)
+
+    # Already a fresh dict built by validate_customer_state
+    customer_state = request.customer_state
+
+    # Build instructions with customer state
+    instructions = get_instructions(customer_state)
+
+    # Run the agent with full conversation on the shared MCP connection
+    mcp_server = await shared_mcp_server.get()
+    hooks = ToolCallHooks()
+    try:
+        result = await Runner.run(build_agent(instructions, mcp_server), conversation, hooks=hooks)
+    except UserError:
+        # The MCP connection may have dropped; reconnect and retry once,
+        # unless a tool already ran
+        if hooks.tool_called:
+            raise
+        mcp_server = await shared_mcp_server.reconnect(mcp_server)
+        result = await Runner.run(build_agent(instructions, mcp_server), conversation, hooks=hooks)
+
+    # Extract response text
+    response_text = result.final_output if hasattr(result, 'final_output') else str(result)
+
+    # Check if verification happened in this response
+    customer_state = detect_verification(response_text, customer_state)
+
+    # Generate conversation ID and store for evaluation
+    conversation_id = record_conversation(sanitized_message, response_text, customer_state)
+
+    return ChatResponse(
+        message=response_text,
+        conversation_id=conversation_id,
+        customer_state=customer_state
+    )
+
+
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest) -> StreamingResponse:
+    """Process chat message, streaming the response as Server-Sent Events.
+
+    Sends {"delta": ...} events as text is generated, then a final
+    {"done": true, ...} event carrying the same fields as ChatResponse
+    (or {"error": ...} if the agent run fails).
+    """
+    sanitized_message, conversation = await prepare_conversation(request)
+    customer_state = request.customer_state
+    instructions = get_instructions(customer_state)
+
+    async def events():
+        streamed = False
+        try:
+            mcp_server = await shared_mcp_server.get()
+            hooks = ToolCallHooks()
+            for attempt in range(2):
+                result = Runner.run_streamed(build_agent(instructions, mcp_server), conversation, hooks=hooks)
+                try:
+                    async for event in result.stream_events():
+                        if event.type == "raw_response_event" and isinstance(event.data, ResponseTextDeltaEvent):
+                            streamed = True
+                            yield sse_event({"delta": event.data.delta})
+                    break
+                except UserError:
+                    # The MCP connection may have dropped; reconnect and retry
+                    # once if nothing has been sent and no tool has run yet
+                    if streamed or attempt or hooks.tool_called:
+                        raise
+                    mcp_server = await shared_mcp_server.reconnect(mcp_server)
+
+            response_text = str(result.final_output)
+            new_state = detect_verification(response_text, customer_state)
+            conversation_id = record_conversation(sanitized_message, response_text, new_state)
+            yield sse_event({
+                "done": True,
+                "message": response_text,
+                "conversation_id": conversation_id,
+                "customer_state": new_state,
+            })
+        except Exception as e:
+            print(f"[ERROR] Streaming chat failed: {e!r}")
+            yield sse_event({"error": "Failed to get response from support agent"})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
 
 
 @app.post("/feedback")
@@ -392,22 +776,14 @@ async def submit_feedback(feedback: UserFeedback):
         raise HTTPException(status_code=404, detail="Conversation not found")
 
     # Store or update evaluation
-    if feedback.conversation_id not in evaluations_store:
-        conv = conversations_store[feedback.conversation_id]
-        evaluations_store[feedback.conversation_id] = {
-            "conversation_id": feedback.conversation_id,
-            "user_query": conv["user_query"],
-            "agent_response": conv["agent_response"],
-            "timestamp": conv["timestamp"],
-            "user_feedback": None,
-            "llm_evaluation": None,
-        }
-
-    evaluations_store[feedback.conversation_id]["user_feedback"] = {
+    evaluation = get_or_create_evaluation(feedback.conversation_id)
+    count_evaluation(evaluation, -1)
+    evaluation["user_feedback"] = {
         "thumbs_up": feedback.thumbs_up,
         "comment": feedback.comment,
         "submitted_at": datetime.utcnow().isoformat(),
     }
+    count_evaluation(evaluation, 1)
 
     return {"status": "ok", "message": "Feedback recorded"}
 
@@ -423,76 +799,57 @@ async def run_evaluation(request: LLMJudgeRequest):
     # Run LLM judge
     llm_result = await run_llm_judge(conv["user_query"], conv["agent_response"])
 
-    # Store evaluation
-    if request.conversation_id not in evaluations_store:
-        evaluations_store[request.conversation_id] = {
-            "conversation_id": request.conversation_id,
-            "user_query": conv["user_query"],
-            "agent_response": conv["agent_response"],
-            "timestamp": conv["timestamp"],
-            "user_feedback": None,
-            "llm_evaluation": None,
-        }
+    # Store evaluation (the conversation may have been evicted while the judge ran)
+    if request.conversation_id not in conversations_store:
+        raise HTTPException(status_code=404, detail="Conversation not found")
 
-    evaluations_store[request.conversation_id]["llm_evaluation"] = {
+    evaluation = get_or_create_evaluation(request.conversation_id)
+    count_evaluation(evaluation, -1)
+    evaluation["llm_evaluation"] = {
         **llm_result,
         "evaluated_at": datetime.utcnow().isoformat(),
     }
+    count_evaluation(evaluation, 1)
 
     return {"status": "ok", "evaluation": llm_result}
 
 
-@app.get("/evaluations")
-async def get_evaluations():
-    """Get all evaluations for the dashboard."""
-    evaluations = list(evaluations_store.values())
-
-    # Calculate summary statistics
-    total = len(evaluations)
-    with_feedback = sum(1 for e in evaluations if e.get("user_feedback"))
-    with_llm_eval = sum(1 for e in evaluations if e.get("llm_evaluation"))
+@app.get("/evaluations", response_model=EvaluationsPage)
+async def get_evaluations(
+    limit: int = Query(50, ge=1, le=500),
+    offset: int = Query(0, ge=0),
+) -> EvaluationsPage:
+    """Get a page of evaluations (newest first) and summary statistics for the dashboard."""
+    evaluations = list(islice(reversed(evaluations_store.values()), offset, offset + limit))
 
-    thumbs_up = sum(
-        1 for e in evaluations
-        if e.get("user_feedback") and e["user_feedback"].get("thumbs_up")
-    )
-    thumbs_down = with_feedback - thumbs_up
-
-    # Average LLM scores
-    llm_scores = [
-        e["llm_evaluation"]["overall_score"]
-        for e in evaluations
-        if e.get("llm_evaluation") and "overall_score" in e["llm_evaluation"]
-    ]
-    avg_llm_score = sum(llm_scores) / len(llm_scores) if llm_scores else 0
+    # Summary statistics from the running totals
+    with_feedback = evaluation_totals["with_user_feedback"]
+    thumbs_up = evaluation_totals["thumbs_up"]
+    llm_score_count = evaluation_totals["llm_score_count"]
+    avg_llm_score = evaluation_totals["llm_score_sum"] / llm_score_count if llm_score_count else 0
 
     # Category averages
-    categories = ["helpfulness", "accuracy", "tone", "completeness", "safety"]
     category_avgs = {}
-    for cat in categories:
-        scores = [
-            e["llm_evaluation"][cat]["score"]
-            for e in evaluations
-            if e.get("llm_evaluation") and cat in e["llm_evaluation"]
-        ]
-        category_avgs[cat] = sum(scores) / len(scores) if scores else 0
-
-    return {
-        "evaluations": evaluations,
-        "summary": {
-            "total_conversations": total,
-            "with_user_feedback": with_feedback,
-            "with_llm_evaluation": with_llm_eval,
-            "thumbs_up": thumbs_up,
-            "thumbs_down": thumbs_down,
-            "average_llm_score": round(avg_llm_score, 2),
-            "category_averages": {k: round(v, 2) for k, v in category_avgs.items()},
-        },
-    }
+    for cat in EVALUATION_CATEGORIES:
+        count = evaluation_totals["category_counts"][cat]
+        category_avgs[cat] = evaluation_totals["category_sums"][cat] / count if count else 0
+
+    return EvaluationsPage(
+        evaluations=evaluations,
+        summary=EvaluationSummary(
+            total_conversations=len(evaluations_store),
+            with_user_feedback=with_feedback,
+            with_llm_evaluation=evaluation_totals["with_llm_evaluation"],
+            thumbs_up=thumbs_up,
+            thumbs_down=with_feedback - thumbs_up,
+            average_llm_score=round(avg_llm_score, 2),
+            category_averages={k: round(v, 2) for k, v in category_avgs.items()},
+        ),
+    )
 
 
-@app.get("/evaluations/{conversation_id}")
-async def get_evaluation(conversation_id: str):
+@app.get("/evaluations/{conversation_id}", response_model=EvaluationResult)
+async def get_evaluation(conversation_id: str) -> EvaluationResult:
     """Get evaluation for a specific conversation."""
     if conversation_id not in conversations_store:
         raise HTTPException(status_code=404, detail="Conversation not found")
@@ -500,14 +857,14 @@ async def get_evaluation(conversation_id: str):
     conv = conversations_store[conversation_id]
     eval_data = evaluations_store.get(conversation_id, {})
 
-    return {
-        "conversation_id": conversation_id,
-        "user_query": conv["user_query"],
-        "agent_response": conv["agent_response"],
-        "timestamp": conv["timestamp"],
-        "user_feedback": eval_data.get("user_feedback"),
-        "llm_evaluation": eval_data.get("llm_evaluation"),
-    }
+    return EvaluationResult(
+        conversation_id=conversation_id,
+        user_query=conv["user_query"],
+        agent_response=conv["agent_response"],
+        timestamp=conv["timestamp"],
+        user_feedback=eval_data.get("user_feedback"),
+        llm_evaluation=eval_data.get("llm_evaluation"),
+    )
 
 
 @app.get("/health")
@@ -3,26 +3,17 @@ TechStore Customer Support Chatbot
 Uses OpenAI Agents SDK with MCP Streamable HTTP
 """
 
-import asyncio
-import os
 import re
 import gradio as gr
 from agents import Agent, Runner
+from agents.exceptions import UserError
 from agents.mcp import MCPServerStreamableHttp
+from config import MCP_SERVER_URL
+from instructions import build_instructions
+from mcp_connection import SharedMCPServer, ToolCallHooks
 
-# Load .env file if present
-from pathlib import Path
-env_path = Path(__file__).parent / ".env"
-if env_path.exists():
-    with open(env_path) as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith("#") and "=" in line:
-                key, value = line.split("=", 1)
-                os.environ.setdefault(key.strip(), value.strip())
-
-# Configuration
-MCP_SERVER_URL = os.getenv("MCP_SERVER_URL", "https://vipfapwm3x.us-east-1.awsapprunner.com/mcp")
+# MCP connection reused across messages, opened on first use
+shared_mcp_server = SharedMCPServer(MCP_SERVER_URL)
 
 BASE_INSTRUCTIONS = """You are a helpful customer support agent for TechStore, a computer products retailer.
 
@@ -45,62 +36,57 @@ Guidelines:
 
 def get_instructions(customer_state: dict) -> str:
     """Build instructions with customer state"""
-    if customer_state.get("verified"):
-        return BASE_INSTRUCTIONS + f"""
+    return build_instructions(BASE_INSTRUCTIONS, customer_state)
 
-IMPORTANT - VERIFIED CUSTOMER SESSION:
-The customer has already been verified. DO NOT ask for verification again.
-- Customer Name: {customer_state.get('name')}
-- Customer ID: {customer_state.get('customer_id')}
 
-Use this customer_id directly for list_orders and create_order calls. The customer is already authenticated.
-"""
-    return BASE_INSTRUCTIONS
+def build_agent(instructions: str, mcp_server: MCPServerStreamableHttp) -> Agent:
+    """Create the support agent bound to an MCP server connection"""
+    return Agent(
+        name="TechStore Support",
+        instructions=instructions,
+        model="gpt-4o-mini",
+        mcp_servers=[mcp_server]
+    )
+
+
+# Patterns for detecting a successful verification in the agent response
+_CID_RE = re.compile(r'Customer ID[:\s]+([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})')
+_NAME_RE = re.compile(r'verified[:\s]+([A-Za-z\s]+?)(?:\n|Customer)')
 
 
 async def chat_async(message: str, history: list, customer_state: dict) -> tuple[str, dict]:
     """Process chat message using OpenAI Agents SDK"""
 
-    # Create fresh MCP connection for each request
-    async with MCPServerStreamableHttp(params={"url": MCP_SERVER_URL, "timeout": 30}) as mcp_server:
-        # Build instructions with customer state
-        instructions = get_instructions(customer_state)
-
-        agent = Agent(
-            name="TechStore Support",
-            instructions=instructions,
-            model="gpt-4o-mini",
-            mcp_servers=[mcp_server]
-        )
-
-        # Run the agent
-        result = await Runner.run(agent, message)
-
-        # Extract response text
-        response_text = result.final_output if hasattr(result, 'final_output') else str(result)
-
-        # Check if verification happened in this response (look for Customer ID in tool output)
-        if not customer_state.get("verified"):
-            id_match = re.search(r'Customer ID[:\s]+([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})', response_text)
-            name_match = re.search(r'verified[:\s]+([A-Za-z\s]+?)(?:\n|Customer)', response_text)
-            if id_match:
-                customer_state = {
-                    "verified": True,
-                    "customer_id": id_match.group(1),
-                    "name": name_match.group(1).strip() if name_match else "Customer",
-                }
-
-        return response_text, customer_state
-
-
-def chat(message: str, history: list, customer_state: dict) -> tuple[str, dict]:
-    """Sync wrapper for async chat"""
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
+    # Build instructions with customer state
+    instructions = get_instructions(customer_state)
+
+    # Run the agent on the shared MCP connection, reconnecting once if it has
+    # dropped before any tool ran
+    mcp_server = await shared_mcp_server.get()
+    hooks = ToolCallHooks()
     try:
-        return loop.run_until_complete(chat_async(message, history, customer_state))
-    finally:
-        loop.close()
+        result = await Runner.run(build_agent(instructions, mcp_server), message, hooks=hooks)
+    except UserError:
+        if hooks.tool_called:
+            raise
+        mcp_server = await shared_mcp_server.reconnect(mcp_server)
+        result = await Runner.run(build_agent(instructions, mcp_server), message, hooks=hooks)
+
+    # Extract response text
+    response_text = result.final_output if hasattr(result, 'final_output') else str(result)
+
+    # Check if verification happened in this response (look for Customer ID in tool output)
+    if not customer_state.get("verified"):
+        id_match = _CID_RE.search(response_text)
+        if id_match:
+            name_match = _NAME_RE.search(response_text)
+            customer_state = {
+                "verified": True,
+                "customer_id": id_match.group(1),
+                "name": name_match.group(1).strip() if name_match else "Customer",
+            }
+
+    return response_text, customer_state
 
 
 # Gradio UI
@@ -126,8 +112,8 @@ with gr.Blocks(title="TechStore Support") as demo:
 
     status = gr.Markdown("*Not logged in*")
 
-    def respond(message, history, cust_state):
-        reply, new_state = chat(message, history, cust_state)
+    async def respond(message, history, cust_state):
+        reply, new_state = await chat_async(message, history, cust_state)
         history.append({"role": "user", "content": message})
         history.append({"role": "assistant", "content": reply})
 
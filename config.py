@@ -0,0 +1,23 @@
+"""
+Configuration shared by the FastAPI and Gradio apps
+"""
+
+import os
+from pathlib import Path
+
+
+def load_env(path: Path) -> None:
+    """Load KEY=VALUE lines from a .env file, without overriding variables already set"""
+    if not path.exists():
+        return
+    for line in path.read_text().splitlines():
+        line = line.strip()
+        if line and not line.startswith("#") and "=" in line:
+            key, value = line.split("=", 1)
+            os.environ.setdefault(key.strip(), value.strip())
+
+
+# Load .env file if present
+load_env(Path(__file__).parent / ".env")
+
+MCP_SERVER_URL = os.getenv("MCP_SERVER_URL", "https://vipfapwm3x.us-east-1.awsapprunner.com/mcp")
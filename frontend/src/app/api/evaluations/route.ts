@@ -1,10 +1,11 @@
-import { NextResponse } from "next/server";
+import { NextRequest, NextResponse } from "next/server";
 
 const API_URL = process.env.API_URL || "http://localhost:8000";
 
-export async function GET() {
+export async function GET(req: NextRequest) {
   try {
-    const response = await fetch(`${API_URL}/evaluations`, {
+    // Forward pagination params (limit, offset) to the backend
+    const response = await fetch(`${API_URL}/evaluations${req.nextUrl.search}`, {
       method: "GET",
       headers: { "Content-Type": "application/json" },
     });
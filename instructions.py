@@ -0,0 +1,31 @@
+"""
+Agent instruction building shared by the FastAPI and Gradio apps
+"""
+
+from functools import lru_cache
+
+VERIFIED_SESSION_INSTRUCTIONS = """
+
+IMPORTANT - VERIFIED CUSTOMER SESSION:
+The customer has already been verified. DO NOT ask for verification again.
+- Customer Name: {name}
+- Customer ID: {customer_id}
+
+Use this customer_id directly for list_orders and create_order calls. The customer is already authenticated.
+"""
+
+
+@lru_cache(maxsize=1024)
+def _verified_instructions(base_instructions: str, name: str, customer_id: str) -> str:
+    return base_instructions + VERIFIED_SESSION_INSTRUCTIONS.format(name=name, customer_id=customer_id)
+
+
+def build_instructions(base_instructions: str, customer_state: dict) -> str:
+    """Build instructions with customer state, reusing the cached prompt for a known customer"""
+    if customer_state.get("verified"):
+        return _verified_instructions(
+            base_instructions,
+            str(customer_state.get("name")),
+            str(customer_state.get("customer_id")),
+        )
+    return base_instructions
@@ -0,0 +1,107 @@
+"""
+Long-lived MCP Streamable HTTP connection shared across chat requests
+"""
+
+import asyncio
+from collections.abc import Callable
+from agents import RunHooks
+from agents.exceptions import ModelBehaviorError
+from agents.mcp import MCPServerStreamableHttp
+from agents.tool import default_tool_error_function
+
+
+class SharedMCPServer:
+    """MCP server connection opened once and reused by every request.
+
+    Each connection is opened and closed inside its own background task, since
+    the MCP client must be cleaned up by the task that opened it.
+
+    A failed tool call does not fail the agent run (the error is handed to the
+    model instead), so the connection is marked stale when one happens and
+    replaced before it is handed out again.
+    """
+
+    def __init__(self, url: str, timeout: float = 30, on_reconnect: Callable[[], None] | None = None):
+        self.url = url
+        self.timeout = timeout
+        self.on_reconnect = on_reconnect  # Called after a connection is replaced
+        self.server: MCPServerStreamableHttp | None = None
+        self._stale: MCPServerStreamableHttp | None = None
+        self._closed: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+
+    async def _hold(self, server: MCPServerStreamableHttp, connected: asyncio.Future, closed: asyncio.Event):
+        try:
+            async with server:
+                connected.set_result(None)
+                await closed.wait()
+        except BaseException as e:
+            if not connected.done():
+                connected.set_exception(e)
+            else:
+                print(f"[MCP] Error closing connection: {e!r}")
+
+    def _tool_failed(self, server: MCPServerStreamableHttp, context, error: Exception) -> str:
+        # Bad arguments from the model say nothing about the connection
+        if not isinstance(error, ModelBehaviorError):
+            print(f"[MCP] Tool call failed, reconnecting before next use: {error!r}")
+            self._stale = server
+        return default_tool_error_function(context, error)
+
+    async def _open(self) -> MCPServerStreamableHttp:
+        server = MCPServerStreamableHttp(
+            params={"url": self.url, "timeout": self.timeout},
+            cache_tools_list=True,
+            failure_error_function=lambda context, error: self._tool_failed(server, context, error),
+        )
+        connected = asyncio.get_running_loop().create_future()
+        closed = asyncio.Event()
+        task = asyncio.create_task(self._hold(server, connected, closed))
+        await connected
+
+        self.server, self._closed, self._task = server, closed, task
+        return server
+
+    async def _close(self):
+        if self._task is not None:
+            self._closed.set()
+            await self._task
+        self.server = self._closed = self._task = None
+
+    async def get(self) -> MCPServerStreamableHttp:
+        """Return the shared connection, opening it on first use and replacing it if stale."""
+        server = self.server
+        if server is not None and server is not self._stale:
+            return server
+        return await self.reconnect(server)
+
+    async def reconnect(self, failed: MCPServerStreamableHttp | None) -> MCPServerStreamableHttp:
+        """Replace a failed connection (unless another request already has)."""
+        async with self._lock:
+            if self.server is failed or self.server is None:
+                replacing = self.server is not None
+                await self._close()
+                await self._open()
+                if replacing and self.on_reconnect is not None:
+                    self.on_reconnect()
+            return self.server
+
+    async def close(self):
+        """Close the shared connection."""
+        async with self._lock:
+            await self._close()
+
+
+class ToolCallHooks(RunHooks):
+    """Run hooks recording whether the agent started any tool call.
+
+    A run that failed after a tool call must not be retried, since the call
+    (e.g. create_order) may already have taken effect.
+    """
+
+    def __init__(self):
+        self.tool_called = False
+
+    async def on_tool_start(self, context, agent, tool) -> None:
+        self.tool_called = True
@@ -0,0 +1,81 @@
+"""
+Evaluation endpoint and running totals tests
+"""
+
+import copy
+
+import pytest
+from fastapi.testclient import TestClient
+
+import api
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # Start every test from empty stores and totals
+    monkeypatch.setattr(api, "evaluations_store", api.OrderedDict())
+    monkeypatch.setattr(api, "conversations_store", api.OrderedDict())
+    monkeypatch.setattr(api, "evaluation_totals", copy.deepcopy(api.evaluation_totals))
+    return TestClient(api.app)
+
+
+def stub_judge(monkeypatch, result):
+    async def run_llm_judge(user_query, agent_response):
+        return result
+    monkeypatch.setattr(api, "run_llm_judge", run_llm_judge)
+
+
+def test_malformed_judge_result(client, monkeypatch):
+    conversation_id = api.record_conversation("Show me monitors", "Here are our monitors", {})
+
+    stub_judge(monkeypatch, {"overall_score": 4, "helpfulness": {"score": 4}, "accuracy": "bad"})
+    assert client.post("/evaluate", json={"conversation_id": conversation_id}).status_code == 200
+
+    summary = client.get("/evaluations").json()["summary"]
+    assert summary["with_llm_evaluation"] == 1
+    assert summary["average_llm_score"] == 4
+    assert summary["category_averages"]["helpfulness"] == 4
+    assert summary["category_averages"]["accuracy"] == 0
+
+    # Re-evaluating replaces the malformed result's contribution
+    stub_judge(monkeypatch, {"overall_score": 2, "accuracy": {"score": 3}})
+    assert client.post("/evaluate", json={"conversation_id": conversation_id}).status_code == 200
+
+    summary = client.get("/evaluations").json()["summary"]
+    assert summary["with_llm_evaluation"] == 1
+    assert summary["average_llm_score"] == 2
+    assert summary["category_averages"]["helpfulness"] == 0
+    assert summary["category_averages"]["accuracy"] == 3
+
+
+def test_feedback_and_eviction_totals(client, monkeypatch):
+    monkeypatch.setattr(api, "MAX_STORED_CONVERSATIONS", 1)
+    conversation_id = api.record_conversation("Hi", "Hello!", {})
+    stub_judge(monkeypatch, {"overall_score": True, "tone": {"score": "5"}})
+    client.post("/evaluate", json={"conversation_id": conversation_id})
+    client.post("/feedback", json={"conversation_id": conversation_id, "thumbs_up": True})
+
+    summary = client.get("/evaluations").json()["summary"]
+    assert summary["thumbs_up"] == 1
+    assert summary["average_llm_score"] == 0
+
+    # Evicting the conversation removes its contribution
+    api.record_conversation("Hi again", "Hello again!", {})
+    assert api.evaluation_totals["with_user_feedback"] == 0
+    assert api.evaluation_totals["with_llm_evaluation"] == 0
+    assert api.evaluation_totals["llm_score_count"] == 0
+    assert api.evaluation_totals["category_counts"]["tone"] == 0
+
+
+def test_get_evaluation(client):
+    conversation_id = api.record_conversation("Hi", "Hello!", {})
+    client.post("/feedback", json={"conversation_id": conversation_id, "thumbs_up": False, "comment": "slow"})
+
+    response = client.get(f"/evaluations/{conversation_id}")
+    assert response.status_code == 200
+    body = response.json()
+    assert body["user_query"] == "Hi"
+    assert body["user_feedback"]["comment"] == "slow"
+    assert body["llm_evaluation"] is None
+
+    assert client.get("/evaluations/unknown").status_code == 404